@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # elasticsearch_upgrade.py
 # https://github.com/pietervogelaar/elasticsearch_upgrade
@@ -7,7 +7,7 @@
 # Based on instructions at https://www.elastic.co/guide/en/elasticsearch/reference/5.4/rolling-upgrades.html
 #
 # Installing dependencies:
-# pip install requests
+# pip install requests packaging
 #
 # MIT License
 #
@@ -32,15 +32,82 @@
 # SOFTWARE.
 
 import argparse
+import atexit
 import json
+import logging
+import random
 import re
 import requests
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from distutils.version import StrictVersion
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass
+from packaging.version import InvalidVersion, Version
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPGRADE_COMMAND = 'sudo yum install -y elasticsearch'
+# The metadata is refreshed once when the latest version is determined, the download then uses the same metadata
+DEFAULT_LATEST_VERSION_COMMAND = "sudo yum -q clean expire-cache && sudo repoquery --qf '%{version}' elasticsearch"
+DEFAULT_DOWNLOAD_COMMAND = 'sudo yum install -y --downloadonly elasticsearch'
+
+# Clutter in the stderr output of SSH commands
+_SSH_CLOSED_RE = re.compile(r"Connection .+? closed by remote host\.\n?", re.IGNORECASE)
+
+# Writes the progress to stdout like the command line does, when the class is used without configuring logging
+_default_handler = logging.StreamHandler(sys.stdout)
+_default_handler.setFormatter(logging.Formatter('%(message)s'))
+
+
+def _configure_default_logging(verbose):
+    """
+    Adds the default handler if logging isn't configured, and then sets the level by the verbose option.
+    Logging that is configured by the caller is left alone, including its levels.
+    :param verbose: bool
+    """
+    if _default_handler not in logger.handlers:
+        if logger.hasHandlers():
+            return
+
+        logger.addHandler(_default_handler)
+
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+
+@dataclass
+class NodeEndpoints:
+    """
+    URLs of the Elasticsearch HTTP endpoints of a node
+    """
+    base: str
+    root: str
+    health: str
+    settings: str
+    flush: str
+    synced_flush: str
+
+    @classmethod
+    def create(cls, base):
+        """
+        Builds all endpoint URLs from the base URL of the node
+        :param base: string
+        :return: NodeEndpoints
+        """
+        return cls(base=base,
+                   root='{}/'.format(base),
+                   health='{}/_cluster/health'.format(base),
+                   settings='{}/_cluster/settings'.format(base),
+                   flush='{}/_flush'.format(base),
+                   synced_flush='{}/_flush/synced'.format(base))
 
 
 class ElasticsearchUpgrader:
@@ -48,6 +115,18 @@ class ElasticsearchUpgrader:
     Performs a rolling upgrade of an Elasticsearch cluster
     """
 
+    # Cluster settings request bodies, these never change so they are serialized only once
+    _DISABLE_ALLOCATION_BODY = json.dumps({'transient': {'cluster.routing.allocation.enable': 'none'}},
+                                          separators=(',', ':')).encode('utf-8')
+    _ENABLE_ALLOCATION_BODY = json.dumps({'transient': {'cluster.routing.allocation.enable': 'all'}},
+                                         separators=(',', ':')).encode('utf-8')
+    _JSON_HEADERS = {'Content-Type': 'application/json'}
+
+    _SYNCED_FLUSH_DEPRECATED_VERSION = Version('7.6.0')
+
+    # Number of output lines kept of SSH commands of which the output is streamed
+    _SSH_OUTPUT_TAIL_LINES = 100
+
     def __init__(self,
                  nodes,
                  username=None,
@@ -56,16 +135,18 @@ class ElasticsearchUpgrader:
                  ssl=False,
                  service_stop_command='sudo systemctl stop elasticsearch',
                  service_start_command='sudo systemctl start elasticsearch',
-                 upgrade_command='sudo yum clean all && sudo yum install -y elasticsearch',
-                 latest_version_command="sudo yum clean all >/dev/null 2>&1 && yum list all elasticsearch |"
-                                        " grep elasticsearch | awk '{ print $2 }' | cut -d '-' -f1 |"
-                                        " sort --version-sort -r | head -n 1",
+                 upgrade_command=DEFAULT_UPGRADE_COMMAND,
+                 latest_version_command=DEFAULT_LATEST_VERSION_COMMAND,
                  version='latest',
                  upgrade_system_command='sudo yum clean all && sudo yum update -y',
                  upgrade_system=False,
                  reboot=False,
                  force_reboot=False,
                  verbose=False,
+                 download_command=None,
+                 check_update_command='',
+                 parallel_health_check=False,
+                 ssh_timeout=1800,
                  ):
         """
         Constructor
@@ -83,7 +164,13 @@ class ElasticsearchUpgrader:
         :param upgrade_system: string
         :param reboot: bool
         :param force_reboot: bool
-        :param verbose: bool
+        :param verbose: bool Only applies if the caller didn't configure logging, otherwise its log level applies
+        :param download_command: string Optional, downloads the upgrade on all nodes before the rolling upgrade.
+                                 Defaults to a yum download, but only if the upgrade command is the default
+        :param check_update_command: string Optional, exit code 0 means no upgrade is available and the node is
+                                     left running. For example 'sudo yum -q check-update elasticsearch'
+        :param parallel_health_check: bool Requires every node to report a green status before starting
+        :param ssh_timeout: int Seconds a SSH command may take
         """
 
         self._nodes = nodes
@@ -101,17 +188,118 @@ class ElasticsearchUpgrader:
         self._reboot = reboot
         self._force_reboot = force_reboot
         self._verbose = verbose
+        self._check_update_command = check_update_command
+        self._parallel_health_check = parallel_health_check
+        self._ssh_timeout = ssh_timeout
+
+        if download_command is None:
+            # A custom upgrade command may not use yum at all, so only download with yum along with the yum upgrade
+            if upgrade_command == DEFAULT_UPGRADE_COMMAND:
+                download_command = DEFAULT_DOWNLOAD_COMMAND
+            else:
+                download_command = ''
+        self._download_command = download_command
+
+        _configure_default_logging(self._verbose)
 
         # Internal class attributes
         self._rebooting = False
         self._elasticsearch_upgrades_available = False
         self._os_upgrades_available = False
+        self._node_version_cache = {}
+
+        # Decided by the number of nodes in the cluster before the upgrade starts
+        self._toggle_shard_allocation = True
+
+        if self._ssl:
+            protocol = 'https'
+        else:
+            protocol = 'http'
+
+        self._endpoints = {node: NodeEndpoints.create('{}://{}:{}'.format(protocol, node, self._port))
+                           for node in self._nodes}
+
+        if self._version and self._version != 'latest':
+            self._target_version = Version(self._version)
+        else:
+            self._target_version = None
+
+        # One session for all HTTP calls, so connections (and TLS sessions) are kept alive and reused.
+        # Transient errors are retried with a backoff and every request has a (connect, read) timeout,
+        # so a node that hangs can't block the rolling upgrade forever.
+        self._timeout = (3.05, 15)
+        self._session = requests.Session()
+        self._session.headers['Connection'] = 'keep-alive'
+        if self._username:
+            self._session.auth = HTTPBasicAuth(self._username, self._password)
+        adapter = HTTPAdapter(pool_connections=max(32, len(nodes)),
+                              pool_maxsize=max(32, len(nodes) * 4),
+                              max_retries=Retry(total=5,
+                                                connect=5,
+                                                read=3,
+                                                backoff_factor=0.3,
+                                                status_forcelist=(502, 503, 504),
+                                                allowed_methods=frozenset(['GET', 'PUT', 'POST']),
+                                                raise_on_status=False))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        # Seconds Elasticsearch may wait for a cluster health condition, the read timeout must be longer than that
+        self._wait_timeout = 30
+        self._wait_request_timeout = (self._timeout[0], self._wait_timeout + self._timeout[1])
+
+        # Multiplex all SSH commands to a node over one connection instead of a new handshake per command.
+        # The control sockets live in a private temporary directory, on exit the master connections are stopped
+        # and the directory is removed.
+        self._ssh_control_dir = tempfile.mkdtemp(prefix='elasticsearch_upgrade-')
+        self._ssh_master_hosts = set()
+        atexit.register(self.stop_ssh_masters)
+        self._ssh_options = [
+            '-o', 'ControlPath={}/%C'.format(self._ssh_control_dir),
+            '-o', 'ControlPersist=60s',
+        ]
+
+        # Worker threads to poll several nodes or run commands on them concurrently
+        self._executor = ThreadPoolExecutor(max_workers=min(32, len(nodes)))
 
     def verbose_response(self, response):
-        if self._verbose:
-            print('Response status code: {}'.format(response.status_code))
-            print('Response headers: {}'.format(response.headers))
-            print('Response content: {}'.format(response.text))
+        # Only decode the response content when it is actually logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Response status code: %s', response.status_code)
+            logger.debug('Response headers: %s', response.headers)
+            logger.debug('Response content: %s', response.text)
+
+    def get_current_version(self, node):
+        """
+        Gets the current version of Elasticsearch on the node, parsed only once
+        :param node: string
+        :return: Version|None
+        """
+        if node in self._node_version_cache:
+            return self._node_version_cache[node]
+
+        # Only let Elasticsearch return the version number instead of the complete cluster info
+        try:
+            response = self._session.get(self._endpoints[node].root,
+                                         params={'filter_path': 'version.number'},
+                                         timeout=self._timeout)
+        except (ConnectionError, Timeout):
+            logger.error("Could not connect to node %s to retrieve the current version", node)
+            return None
+        self.verbose_response(response)
+
+        if response.status_code != 200:
+            logger.error("Could not retrieve the current version")
+            return None
+
+        data = response.json()
+        try:
+            self._node_version_cache[node] = Version(data['version']['number'])
+        except (KeyError, InvalidVersion):
+            logger.error("Could not determine the current version")
+            return None
+
+        return self._node_version_cache[node]
 
     def current_version_lower(self, node):
         """
@@ -120,35 +308,22 @@ class ElasticsearchUpgrader:
         :param node: string
         :return: bool
         """
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
-        else:
-            auth = None
-
-        response = requests.get(self.get_node_url(node), auth=auth)
-        self.verbose_response(response)
+        current_version = self.get_current_version(node)
+        if not current_version:
+            return False
 
-        if response.status_code == 200:
-            data = response.json()
-            if 'version' in data and 'number' in data['version']:
-                if StrictVersion(data['version']['number']) == StrictVersion(self._version):
-                    print('Skipping upgrade, the current version {} is the same as the version to upgrade to'
-                          .format(data['version']['number']))
-                    return False
-                elif StrictVersion(data['version']['number']) > StrictVersion(self._version):
-                    print('Skipping upgrade, the current version {} is higher than version {} to upgrade to'
-                          .format(data['version']['number'], self._version))
-                    return False
-                else:
-                    print('The current version {} is lower than version {} to upgrade to'
-                          .format(data['version']['number'], self._version))
-                    return True
-            else:
-                sys.stderr.write("Could not determine the current version\n")
+        if current_version == self._target_version:
+            logger.info('Skipping upgrade, the current version %s is the same as the version to upgrade to',
+                        current_version)
+            return False
+        elif current_version > self._target_version:
+            logger.info('Skipping upgrade, the current version %s is higher than version %s to upgrade to',
+                        current_version, self._version)
+            return False
         else:
-            sys.stderr.write("Could not retrieve the current version\n")
-
-        return False
+            logger.info('The current version %s is lower than version %s to upgrade to',
+                        current_version, self._version)
+            return True
 
     def disable_shard_allocation(self, node):
         """
@@ -156,22 +331,11 @@ class ElasticsearchUpgrader:
         :param node: string
         :return: bool
         """
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
-        else:
-            auth = None
+        response = self.cluster_request(node, 'PUT', 'settings',
+                                        data=self._DISABLE_ALLOCATION_BODY,
+                                        headers=self._JSON_HEADERS)
 
-        data = {
-            'transient': {
-                'cluster.routing.allocation.enable': 'none'
-            }
-        }
-
-        url = '{}/_cluster/settings'.format(self.get_node_url(node))
-        response = requests.put(url, json=data, auth=auth)
-        self.verbose_response(response)
-
-        return response.status_code == 200
+        return response is not None and response.status_code == 200
 
     def enable_shard_allocation(self, node):
         """
@@ -179,41 +343,51 @@ class ElasticsearchUpgrader:
         :param node: string
         :return: bool
         """
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
-        else:
-            auth = None
-
-        data = {
-            'transient': {
-                'cluster.routing.allocation.enable': 'all'
-            }
-        }
-
-        url = '{}/_cluster/settings'.format(self.get_node_url(node))
-        response = requests.put(url, json=data, auth=auth)
-        self.verbose_response(response)
+        response = self.cluster_request(node, 'PUT', 'settings',
+                                        data=self._ENABLE_ALLOCATION_BODY,
+                                        headers=self._JSON_HEADERS)
 
-        return response.status_code == 200
+        return response is not None and response.status_code == 200
 
     def do_synced_flush(self, node):
         """
-        Stops non-essential indexing and performs a synced flush to increase shard recovery speed
+        Stops non-essential indexing and performs a synced flush to increase shard recovery speed.
+        Synced flush is deprecated since Elasticsearch 7.6, where a normal flush does the same.
         :param node: string
         :return: bool
         """
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
+        current_version = self.get_current_version(node)
+        if current_version and current_version >= self._SYNCED_FLUSH_DEPRECATED_VERSION:
+            endpoint = 'flush'
         else:
-            auth = None
+            endpoint = 'synced_flush'
 
         data = {}
-        url = '{}/_flush/synced'.format(self.get_node_url(node))
-        response = requests.post(url, json=data, auth=auth)
-        self.verbose_response(response)
+        response = self.cluster_request(node, 'POST', endpoint, json=data)
 
         # This operation is best effort, so ignore the response status code
-        return True
+        return response is not None
+
+    def cluster_request(self, node, method, endpoint, **kwargs):
+        """
+        Sends a cluster wide request to the first node that can be reached, the node itself last
+        :param node: string
+        :param method: string
+        :param endpoint: string Name of the NodeEndpoints attribute with the URL
+        :param kwargs: Passed on to the request
+        :return: Response|None None if none of the nodes could be reached
+        """
+        for endpoints in self.get_cluster_endpoints(node):
+            url = getattr(endpoints, endpoint)
+            try:
+                response = self._session.request(method, url, timeout=self._timeout, **kwargs)
+                self.verbose_response(response)
+
+                return response
+            except (ConnectionError, Timeout):
+                logger.debug("Could not connect to %s", url)
+
+        return None
 
     def stop_service(self, node):
         """
@@ -228,6 +402,38 @@ class ElasticsearchUpgrader:
 
         return True
 
+    def download_elasticsearch(self, nodes):
+        """
+        Downloads the Elasticsearch software on the nodes at once, without installing it yet
+        :param nodes: list
+        :return: list Nodes on which the download failed
+        """
+
+        results = self.ssh_command_many(nodes, self._download_command)
+
+        failed_nodes = []
+        for node in nodes:
+            logger.debug('stdout of %s:\n%s', node, results[node]['stdout'])
+            logger.debug('stderr of %s:\n%s', node, results[node]['stderr'])
+
+            if results[node]['exit_code'] != 0:
+                failed_nodes.append(node)
+
+        return failed_nodes
+
+    def elasticsearch_upgrade_available(self, node):
+        """
+        Checks with the check update command if an Elasticsearch upgrade is available on the node
+        :param node: string
+        :return: bool False only if the exit code is 0, any other exit code means there is or might be an upgrade
+        """
+
+        result = self.ssh_command(node, self._check_update_command)
+
+        logger.debug('stdout:\n%s', result['stdout'])
+
+        return result['exit_code'] != 0
+
     def upgrade_elasticsearch(self, node):
         """
         Upgrades the Elasticsearch software on the node
@@ -237,11 +443,8 @@ class ElasticsearchUpgrader:
 
         result = self.ssh_command(node, self._upgrade_command)
 
-        if self._verbose:
-            print('stdout:')
-            print(result['stdout'])
-            print('stderr:')
-            print(result['stderr'])
+        logger.debug('stdout:\n%s', result['stdout'])
+        logger.debug('stderr:\n%s', result['stderr'])
 
         if result['exit_code'] != 0:
             return False
@@ -259,21 +462,24 @@ class ElasticsearchUpgrader:
         :param node: string
         :return: bool
         """
-        result = self.ssh_command(node, self._upgrade_system_command)
+        # The output of a system upgrade can be huge, so only look for the marker while it is streamed
+        nothing_to_update = []
 
-        if self._verbose:
-            print('stdout:')
-            print(result['stdout'])
-            print('stderr:')
-            print(result['stderr'])
+        def check_line(line):
+            logger.debug('%s', line.rstrip('\n'))
+            if 'No packages marked for update' in line:
+                nothing_to_update.append(True)
+
+        # The same stdout and stderr blocks as the other commands, only the stdout lines are logged as they come in
+        logger.debug('stdout:')
+        result = self.ssh_command_streamed(node, self._upgrade_system_command, check_line)
+
+        logger.debug('stderr:\n%s', result['stderr'])
 
         if result['exit_code'] != 0:
             return False
 
-        if 'No packages marked for update' in result['stdout']:
-            self._os_upgrades_available = False
-        else:
-            self._os_upgrades_available = True
+        self._os_upgrades_available = not nothing_to_update
 
         return True
 
@@ -297,39 +503,60 @@ class ElasticsearchUpgrader:
         :return: bool
         """
 
-        print('- Waiting until node joins the cluster')
+        logger.info('- Waiting until node joins the cluster')
 
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
-        else:
-            auth = None
+        # Let Elasticsearch wait until all nodes are in the cluster, instead of asking again and again.
+        # The other nodes are asked as well, because they know when the node joined while it is still starting.
+        health_urls = [endpoints.health for endpoints in self.get_cluster_endpoints(node)]
+        health_params = {
+            'wait_for_nodes': '>={}'.format(len(self._nodes)),
+            'timeout': '{}s'.format(self._wait_timeout),
+        }
 
-        url = '{}/_cat/nodes'.format(self.get_node_url(node))
+        # Then make sure it is this node that joined. The response only contains the node names,
+        # and the "nodes" key is left out entirely if the node is not in the cluster.
+        nodes_urls = ['{}/_nodes/{}'.format(endpoints.base, node) for endpoints in self.get_cluster_endpoints(node)]
+        nodes_params = {'filter_path': 'nodes.*.name'}
 
+        failed_attempts = 0
         while True:
-            time.sleep(5)
+            joined = self.poll(health_urls, lambda response: not response.json()['timed_out'], health_params,
+                               self._wait_request_timeout)
+            if joined:
+                joined = self.poll(nodes_urls, lambda response: bool(response.json().get('nodes')), nodes_params)
 
-            try:
-                response = requests.get(url, auth=auth)
-                self.verbose_response(response)
+            if joined:
+                self.log_progress("Node joined the cluster", done=True)
+
+                return True
 
-                if response.status_code == 200 and node in response.text:
-                    if self._verbose:
-                        print("Node joined the cluster")
-                    else:
-                        sys.stdout.write(".\n")
-                        sys.stdout.flush()
+            self.log_progress("Node hasn't joined the cluster yet")
 
-                    return True
-            except ConnectionError as exception:
-                if self._verbose:
-                    print('Could not connect to node')
+            failed_attempts = failed_attempts + 1 if joined is None else 0
+            self.poll_sleep(failed_attempts)
 
-            if self._verbose:
-                print("Node hasn't joined the cluster yet")
-            else:
-                sys.stdout.write('.')
-                sys.stdout.flush()
+    def wait_until_left(self, node):
+        """
+        Waits until the node left the cluster
+        :param node:
+        """
+
+        logger.info('- Waiting until node leaves the cluster')
+
+        nodes_urls = ['{}/_nodes/{}'.format(endpoints.base, node) for endpoints in self.get_cluster_endpoints(node)]
+        nodes_params = {'filter_path': 'nodes.*.name'}
+
+        while True:
+            # The node left if the cluster doesn't know it anymore, or if none of the nodes can be reached at all
+            left = self.poll(nodes_urls, lambda response: not response.json().get('nodes'), nodes_params)
+            if left is not False:
+                self.log_progress("Node left the cluster", done=True)
+
+                return
+
+            self.log_progress("Node hasn't left the cluster yet")
+
+            self.poll_sleep()
 
     def wait_until_status_green(self, node):
         """
@@ -337,57 +564,132 @@ class ElasticsearchUpgrader:
         :param node:
         :return: bool
         """
-        print('- Waiting until cluster status is green')
+        logger.info('- Waiting until cluster status is green')
+
+        # The cluster status is the same on every node, so ask all of them and use the first green answer.
+        # Elasticsearch responds as soon as the status is green, or with "timed_out" after the timeout.
+        urls = [endpoints.health for endpoints in self.get_cluster_endpoints(node)]
+        params = {
+            'wait_for_status': 'green',
+            'wait_for_no_relocating_shards': 'true',
+            'timeout': '{}s'.format(self._wait_timeout),
+        }
 
+        failed_attempts = 0
         while True:
-            time.sleep(5)
-
-            if self.get_cluster_status(node) == 'green':
-                if self._verbose:
-                    print('Cluster status is green')
-                else:
-                    sys.stdout.write(".\n")
-                    sys.stdout.flush()
+            green = self.poll(urls, self.is_health_green, params, self._wait_request_timeout)
+            if green:
+                self.log_progress('Cluster status is green', done=True)
 
                 return True
 
-            if self._verbose:
-                print('Cluster status is not green yet')
-            else:
-                sys.stdout.write('.')
-                sys.stdout.flush()
+            self.log_progress('Cluster status is not green yet')
 
-    def get_cluster_status(self, node):
+            failed_attempts = failed_attempts + 1 if green is None else 0
+            self.poll_sleep(failed_attempts)
+
+    @staticmethod
+    def is_health_green(response):
         """
-        Gets the cluster status
-        :param node:
-        :return: string "green", "yellow" or "red"
+        Checks if a cluster health response that waited for status green actually is green
+        :param response: Response
+        :return: bool
         """
-        cluster_status = None
+        data = response.json()
 
-        if self._username:
-            auth = HTTPBasicAuth(self._username, self._password)
+        return data['status'] == 'green' and not data['timed_out']
+
+    @staticmethod
+    def log_progress(message, done=False):
+        """
+        Logs the progress message in verbose mode, otherwise only writes a dot to show that it's still waiting
+        :param message: string
+        :param done: bool Ends the line of dots
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message)
         else:
-            auth = None
+            sys.stdout.write(".\n" if done else '.')
+            sys.stdout.flush()
+
+    def poll(self, urls, predicate, params=None, timeout=None):
+        """
+        Requests all URLs concurrently and checks the responses
+        :param urls: list
+        :param predicate: function Receives a successful response and returns a bool
+        :param params: dict Query string parameters
+        :param timeout: tuple Connect and read timeout, defaults to the regular timeout
+        :return: bool|None True as soon as one of the responses satisfies the predicate,
+                 None if none of the URLs could be reached
+        """
+        futures = [self._executor.submit(self.poll_url, url, predicate, params, timeout) for url in urls]
+
+        result = None
+        for future in as_completed(futures):
+            if future.result():
+                # Requests that didn't start yet are not needed anymore and would only hold up the next poll
+                for pending in futures:
+                    pending.cancel()
+
+                return True
+            elif future.result() is False:
+                result = False
+
+        return result
+
+    def poll_url(self, url, predicate, params=None, timeout=None):
+        """
+        Requests a single URL and checks the response
+        :param url: string
+        :param predicate: function Receives a successful response and returns a bool
+        :param params: dict Query string parameters
+        :param timeout: tuple Connect and read timeout, defaults to the regular timeout
+        :return: bool|None False if the response is not the expected JSON, None if the URL could not be reached
+        """
+        try:
+            response = self._session.get(url, params=params, timeout=timeout or self._timeout)
+            self.verbose_response(response)
+
+            return response.status_code == 200 and predicate(response)
+        except (ConnectionError, Timeout):
+            logger.debug('Could not connect to %s', url)
+        except (ValueError, KeyError):
+            # Not the expected JSON, for example from a proxy or another service on the port
+            logger.debug('Unexpected response from %s', url)
+
+            return False
+
+        return None
 
-        url = '{}/_cat/health'.format(self.get_node_url(node))
+    @staticmethod
+    def poll_sleep(failed_attempts=0):
+        """
+        Sleeps between two polls, with some jitter so nodes are not hit in lockstep.
+        The sleep doubles with every consecutive attempt in which no node could be reached, up to a minute.
+        :param failed_attempts: int
+        """
+        time.sleep(min(60, 2 ** min(failed_attempts, 6)) + random.uniform(0, 1))
 
+    def get_cluster_health(self, node):
+        """
+        Gets the cluster status and the number of nodes in the cluster, as seen by the node itself
+        :param node:
+        :return: dict|None With "status" "green", "yellow" or "red" and "number_of_nodes"
+        """
+        # Don't fall back to the other nodes, a node that can't be reached can't be upgraded either
+        url = self._endpoints[node].health
         try:
-            response = requests.get(url, auth=auth)
+            response = self._session.get(url,
+                                         params={'filter_path': 'status,number_of_nodes'},
+                                         timeout=self._timeout)
             self.verbose_response(response)
 
             if response.status_code == 200:
-                if 'green' in response.text:
-                    cluster_status = 'green'
-                elif 'yellow' in response.text:
-                    cluster_status = 'yellow'
-                elif 'red' in response.text:
-                    cluster_status = 'red'
-        except ConnectionError as exception:
-            if self._verbose:
-                sys.stderr.write("Could not connect to node\n")
-
-        return cluster_status
+                return response.json()
+        except (ConnectionError, Timeout):
+            logger.debug("Could not connect to %s", url)
+
+        return None
 
     def get_latest_version(self, node):
         """
@@ -398,31 +700,39 @@ class ElasticsearchUpgrader:
 
         result = self.ssh_command(node, self._latest_version_command)
         if result['exit_code'] != 0:
+            # The stderr output is already reported, a missing repoquery for example shows "command not found"
+            logger.error("Latest version command failed on host %s with exit code %s", node, result['exit_code'])
             return False
 
-        latest_version = result['stdout'].strip()
-        if StrictVersion(latest_version) > StrictVersion('0.0.0'):
-            return latest_version
+        # The command may list all available versions, so pick the highest one here instead of sorting remotely
+        versions = []
+        for line in result['stdout'].splitlines():
+            try:
+                versions.append(Version(line.strip()))
+            except InvalidVersion:
+                logger.debug("Ignoring invalid version '%s' from host %s", line.strip(), node)
+
+        if versions and max(versions) > Version('0.0.0'):
+            return str(max(versions))
+
+        logger.error("No valid latest version from host %s", node)
 
         return False
 
     def reboot(self, node):
-        print('- Rebooting')
+        logger.info('- Rebooting')
         self._rebooting = True
         self.ssh_command(node, 'sudo /sbin/reboot')
 
-    def get_node_url(self, node):
+    def get_cluster_endpoints(self, node):
         """
-        Gets a node URL
+        Gets the endpoints of all nodes for cluster wide requests, with the node itself last
+        because that is the one that is being upgraded and most likely unavailable.
+        The first one is the first other node, so mostly the same kept alive connection is reused.
         :param node: string
-        :return: string
+        :return: list NodeEndpoints
         """
-        if self._ssl:
-            protocol = 'https'
-        else:
-            protocol = 'http'
-
-        return '{}://{}:{}'.format(protocol, node, self._port)
+        return [self._endpoints[n] for n in self._nodes if n != node] + [self._endpoints[node]]
 
     def ssh_command(self, host, command):
         """
@@ -431,107 +741,224 @@ class ElasticsearchUpgrader:
         :param command: string
         :return: dict
         """
-        p = subprocess.Popen(['ssh', '%s' % host, command],
-                             shell=False,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        self.start_ssh_master(host)
+
+        # Without a master connection, for example while the host reboots, this just connects directly
+        args = ['ssh'] + self._ssh_options + ['-o', 'ControlMaster=no', host, command]
+
+        try:
+            completed_process = subprocess.run(args, capture_output=True, timeout=self._ssh_timeout)
+            stdout = completed_process.stdout
+            stderr = completed_process.stderr
+            exit_code = completed_process.returncode
+        except subprocess.TimeoutExpired as exception:
+            # The SSH process is killed, so only the output until then is available
+            stdout = exception.stdout or b''
+            stderr = exception.stderr or b''
+            exit_code = -1
+            logger.error("SSH command on host %s timed out after %s seconds", host, self._ssh_timeout)
+
+        return self.ssh_result(host, stdout.decode('utf-8', 'replace'), stderr, exit_code)
+
+    def ssh_command_streamed(self, host, command, line_callback):
+        """
+        Executes a SSH command and passes its output line by line to the callback, instead of buffering it all.
+        Only the last lines of the output are kept in the result.
+        :param host: string
+        :param command: string
+        :param line_callback: function Receives every line of stdout
+        :return: dict
+        """
+        self.start_ssh_master(host)
+
+        args = ['ssh'] + self._ssh_options + ['-o', 'ControlMaster=no', host, command]
+        stdout_tail = deque(maxlen=self._SSH_OUTPUT_TAIL_LINES)
+        timed_out = threading.Event()
+
+        # Stderr goes to a file, so it can't fill up a pipe while stdout is being read
+        with tempfile.TemporaryFile() as stderr_file:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_file)
+
+            def kill():
+                timed_out.set()
+                p.kill()
+
+            timer = threading.Timer(self._ssh_timeout, kill)
+            timer.start()
+            try:
+                for line in p.stdout:
+                    line = line.decode('utf-8', 'replace')
+                    stdout_tail.append(line)
+                    line_callback(line)
+
+                exit_code = p.wait()
+            finally:
+                timer.cancel()
+                p.stdout.close()
 
-        stdout = p.stdout.readlines()
-        stderr = p.stderr.readlines()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
 
-        stdout_string = ''.join(stdout)
-        stderr_string = ''.join(stderr)
+        if timed_out.is_set():
+            exit_code = -1
+            logger.error("SSH command on host %s timed out after %s seconds", host, self._ssh_timeout)
 
+        return self.ssh_result(host, ''.join(stdout_tail), stderr, exit_code)
+
+    @staticmethod
+    def ssh_result(host, stdout_string, stderr, exit_code):
+        """
+        Creates the result of a SSH command and reports errors
+        :param host: string
+        :param stdout_string: string
+        :param stderr: bytes
+        :param exit_code: int
+        :return: dict
+        """
         # Remove clutter
-        regex = re.compile(r"Connection .+? closed by remote host\.\n?", re.IGNORECASE)
-        stderr_string = regex.sub('', stderr_string).strip()
+        stderr_string = _SSH_CLOSED_RE.sub('', stderr.decode('utf-8', 'replace')).strip()
 
         if stderr_string:
-            sys.stderr.write("SSH error from host {}: {}\n".format(host, stderr_string))
-
-        # Make a return code available
-        p.communicate()[0]
+            logger.error("SSH error from host %s: %s", host, stderr_string)
 
         result = {
             'stdout': stdout_string,
             'stderr': stderr_string,
-            'exit_code': p.returncode,
+            'exit_code': exit_code,
         }
 
         return result
 
+    def start_ssh_master(self, host):
+        """
+        Starts a master SSH connection to the host in the background, unless it is already running.
+        Its output is not captured, because the background process would keep the pipes open.
+        :param host: string
+        """
+        check = subprocess.run(['ssh'] + self._ssh_options + ['-O', 'check', host],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+        if check.returncode == 0:
+            return
+
+        try:
+            subprocess.run(['ssh'] + self._ssh_options + ['-o', 'ControlMaster=yes', '-f', '-N', host],
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL,
+                           timeout=self._ssh_timeout)
+            self._ssh_master_hosts.add(host)
+        except subprocess.TimeoutExpired:
+            logger.debug('Could not start a master SSH connection to %s', host)
+
+    def stop_ssh_masters(self):
+        """
+        Stops the master SSH connections that were started and removes their control sockets
+        """
+        for host in self._ssh_master_hosts:
+            # Also fine if the master already stopped by itself, for example because the host rebooted
+            subprocess.run(['ssh'] + self._ssh_options + ['-O', 'exit', host],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+
+        shutil.rmtree(self._ssh_control_dir, True)
+
+    def ssh_command_many(self, hosts, command):
+        """
+        Executes the same SSH command on multiple hosts at once.
+        Only use this for commands that are safe to run on all nodes of the cluster at the same time.
+        :param hosts: list
+        :param command: string
+        :return: dict Result per host
+        """
+        results = self._executor.map(lambda host: self.ssh_command(host, command), hosts)
+
+        return dict(zip(hosts, results))
+
     def upgrade_node(self, node):
-        print('# Node {}'.format(node))
+        logger.info('# Node %s', node)
 
         self._rebooting = False
         self._elasticsearch_upgrades_available = False
         self._os_upgrades_available = False
 
-        if self._version:
-            # Only upgrade node if the current version is lower than the version to upgrade to
-            if not self.current_version_lower(node):
-                # Elasticsearch already up to date
-
-                if self._upgrade_system:
-                    print('- Upgrading operating system')
-                    if not self.upgrade_system(node):
-                        sys.stderr.write("Failed to upgrade operating system\n")
-                        return False
-                    else:
-                        if not self._os_upgrades_available:
-                            print('No operating system upgrades available')
+        # Only upgrade node if the current version is lower than the version to upgrade to
+        up_to_date = bool(self._version) and not self.current_version_lower(node)
+
+        if not up_to_date and self._check_update_command:
+            # Checked before the service is stopped, so the node isn't restarted for nothing
+            if not self.elasticsearch_upgrade_available(node):
+                logger.info('No Elasticsearch upgrade available')
+                up_to_date = True
+
+        if up_to_date:
+            # Elasticsearch already up to date
+
+            if self._upgrade_system:
+                logger.info('- Upgrading operating system')
+                if not self.upgrade_system(node):
+                    logger.error("Failed to upgrade operating system")
+                    return False
+                else:
+                    if not self._os_upgrades_available:
+                        logger.info('No operating system upgrades available')
 
-                if self._force_reboot or (self._reboot and self._os_upgrades_available):
+            if self._force_reboot or (self._reboot and self._os_upgrades_available):
+                if self._toggle_shard_allocation:
                     # Disable shard allocation
-                    print('- Disabling shard allocation')
+                    logger.info('- Disabling shard allocation')
                     if not self.disable_shard_allocation(node):
-                        sys.stderr.write("Failed to disable shard allocation\n")
+                        logger.error("Failed to disable shard allocation")
                         return False
 
-                    # Stop non-essential indexing and perform a synced flush to increase shard recovery speed
-                    print('- Performing a synced flush')
-                    if not self.do_synced_flush(node):
-                        sys.stderr.write("Failed to perform a synced flush\n")
-                        return False
+                # Stop non-essential indexing and flush (synced before 7.6) to increase shard recovery speed
+                logger.info('- Flushing')
+                if not self.do_synced_flush(node):
+                    logger.error("Failed to flush")
+                    return False
 
-                    # Reboot
-                    self.reboot(node)
-                else:
-                    return True
+                # Reboot
+                self.reboot(node)
+            else:
+                return True
 
         if not self._rebooting:
-            # Disable shard allocation
-            print('- Disabling shard allocation')
-            if not self.disable_shard_allocation(node):
-                sys.stderr.write("Failed to disable shard allocation\n")
-                return False
+            if self._toggle_shard_allocation:
+                # Disable shard allocation
+                logger.info('- Disabling shard allocation')
+                if not self.disable_shard_allocation(node):
+                    logger.error("Failed to disable shard allocation")
+                    return False
 
-            # Stop non-essential indexing and perform a synced flush to increase shard recovery speed
-            print('- Performing a synced flush')
+            # Stop non-essential indexing and flush (synced before 7.6) to increase shard recovery speed
+            logger.info('- Flushing')
             if not self.do_synced_flush(node):
-                sys.stderr.write("Failed to perform a synced flush\n")
+                logger.error("Failed to flush")
                 return False
 
             # Stop Elasticsearch service
-            print('- Stopping Elasticsearch service')
+            logger.info('- Stopping Elasticsearch service')
             if not self.stop_service(node):
-                sys.stderr.write("Failed to stop Elasticsearch service\n")
+                logger.error("Failed to stop Elasticsearch service")
                 return False
 
+            # The version will change, so it must be retrieved again next time
+            self._node_version_cache.pop(node, None)
+
             # Upgrade the Elasticsearch software
-            print('- Upgrading Elasticsearch software')
+            logger.info('- Upgrading Elasticsearch software')
             if not self.upgrade_elasticsearch(node):
-                sys.stderr.write("Failed to upgrade Elasticsearch software\n")
+                logger.error("Failed to upgrade Elasticsearch software")
                 return False
 
             if self._upgrade_system:
-                print('- Upgrading operating system')
+                logger.info('- Upgrading operating system')
                 if not self.upgrade_system(node):
-                    sys.stderr.write("Failed to upgrade operating system\n")
+                    logger.error("Failed to upgrade operating system")
                     return False
                 else:
                     if not self._os_upgrades_available:
-                        print('No operating system upgrades available')
+                        logger.info('No operating system upgrades available')
 
             if (self._force_reboot or
                (self._reboot and (self._elasticsearch_upgrades_available or self._os_upgrades_available))):
@@ -539,52 +966,99 @@ class ElasticsearchUpgrader:
 
             if not self._rebooting:
                 # Start Elasticsearch service
-                print('- Starting Elasticsearch service')
+                logger.info('- Starting Elasticsearch service')
                 if not self.start_service(node):
-                    sys.stderr.write("Failed to start Elasticsearch service\n")
+                    logger.error("Failed to start Elasticsearch service")
                     return False
 
+        if self._rebooting:
+            # A node that reboots without a service stop is still in the cluster right after the reboot command
+            self.wait_until_left(node)
+
         self.wait_until_joined(node)
 
-        # Enable shard allocation
-        print('- Enabling shard allocation')
-        if not self.enable_shard_allocation(node):
-            sys.stderr.write("Failed to enable shard allocation\n")
-            return False
+        if self._toggle_shard_allocation:
+            # Enable shard allocation
+            logger.info('- Enabling shard allocation')
+            if not self.enable_shard_allocation(node):
+                logger.error("Failed to enable shard allocation")
+                return False
 
         self.wait_until_status_green(node)
 
         return True
 
     def upgrade(self):
-        print('Performing a rolling upgrade of the Elasticsearch cluster')
+        logger.info('Performing a rolling upgrade of the Elasticsearch cluster')
 
-        if self._verbose:
-            print('Cluster nodes: {}'.format(json.dumps(self._nodes)))
+        logger.debug('Cluster nodes: %s', json.dumps(self._nodes))
+
+        # Connect to one node at a time first, so host key, password or passphrase prompts can be answered one by one.
+        # The SSH commands that run on several nodes at once then reuse these connections.
+        for node in self._nodes:
+            self.start_ssh_master(node)
 
         if self._version == 'latest':
-            print('Determining the latest version')
+            logger.info('Determining the latest version')
+
+            # Ask all nodes at once, they should all use the same repository
+            latest_versions = [v for v in self._executor.map(self.get_latest_version, self._nodes) if v]
+            if latest_versions:
+                latest_version = max(latest_versions, key=Version)
+
+                if len(set(latest_versions)) > 1 or len(latest_versions) < len(self._nodes):
+                    logger.warning("Not all nodes report the same latest version %s", latest_version)
 
-            latest_version = self.get_latest_version(self._nodes[0])
-            if latest_version:
-                print('Using latest version {} as version to upgrade to'.format(latest_version))
+                logger.info('Using latest version %s as version to upgrade to', latest_version)
                 self._version = latest_version
+                self._target_version = Version(latest_version)
             else:
-                sys.stderr.write("Failed to determine the latest version\n")
+                logger.error("Failed to determine the latest version")
                 return False
 
+        version_futures = []
+        if self._version:
+            # Retrieve the current version of all nodes at once, the rolling upgrade uses the cached versions.
+            # Failures are ignored here, the version is retrieved again when the node is upgraded.
+            version_futures = [self._executor.submit(self.get_current_version, node) for node in self._nodes]
+
         # Only start upgrading the cluster if the cluster status is green
-        print('Checking if cluster status is green')
-        if self.get_cluster_status(self._nodes[0]) != 'green':
-            sys.stderr.write("Did not start upgrading the cluster because the status is not green\n")
+        logger.info('Checking if cluster status is green')
+        if self._parallel_health_check:
+            # Every node must be reachable and agree, asked all at once so it takes no longer than asking one
+            healths = list(self._executor.map(self.get_cluster_health, self._nodes))
+        else:
+            healths = [self.get_cluster_health(self._nodes[0])]
+
+        wait(version_futures)
+
+        if not all(health and health.get('status') == 'green' for health in healths):
+            logger.error("Did not start upgrading the cluster because the status is not green")
             return False
 
+        # Shards of a single node cluster can't be allocated anywhere else, so there is no need to toggle allocation.
+        # This counts the nodes in the cluster, because only some of them may be given to upgrade.
+        self._toggle_shard_allocation = max(health.get('number_of_nodes', 0) for health in healths) != 1
+
+        # Nodes that already have the version to upgrade to don't need the download.
+        # If the current version is unknown, the node is upgraded anyway, so it downloads as well.
+        download_nodes = [node for node in self._nodes
+                          if not self._version
+                          or self._node_version_cache.get(node) is None
+                          or self._node_version_cache[node] < self._target_version]
+
+        if self._download_command and download_nodes:
+            # Downloading does not affect the cluster, so do it on all nodes at once before the rolling upgrade
+            logger.info('Downloading Elasticsearch software on nodes %s', ', '.join(download_nodes))
+            for node in self.download_elasticsearch(download_nodes):
+                logger.warning("Failed to download Elasticsearch software on node %s", node)
+
         for node in self._nodes:
             if not self.upgrade_node(node):
-                sys.stderr.write("Failed to patch the Elasticsearch cluster\n")
+                logger.error("Failed to patch the Elasticsearch cluster")
                 return False
 
-        print ('Successfully upgraded all nodes of the Elasticsearch cluster')
+        logger.info('Successfully upgraded all nodes of the Elasticsearch cluster')
 
         return True
 
@@ -605,18 +1079,26 @@ def main():
                         help="Shell command to start the Elasticsearch service on a node. "
                              "Default 'sudo systemctl start elasticsearch'",
                         default='sudo systemctl start elasticsearch')
+    parser.add_argument('--download-command',
+                        help="Command to download the Elasticsearch upgrade on a node. It runs at once on all nodes"
+                             " that need the upgrade before the rolling upgrade starts, an empty string disables it."
+                             " Default '{}', but only if the upgrade command is the default".format(
+                                 DEFAULT_DOWNLOAD_COMMAND))
+    parser.add_argument('--check-update-command',
+                        help="Command to check if an Elasticsearch upgrade is available on a node, before its"
+                             " service is stopped. Exit code 0 means there is none and leaves the node running,"
+                             " for example 'sudo yum -q check-update elasticsearch'. Default disabled",
+                        default='')
     parser.add_argument('--upgrade-command',
                         help="Command to upgrade Elasticsearch on a node. "
-                             "Default 'sudo yum clean all && sudo yum install -y elasticsearch'",
-                        default='sudo yum clean all && sudo yum install -y elasticsearch')
+                             "Default '{}'".format(DEFAULT_UPGRADE_COMMAND),
+                        default=DEFAULT_UPGRADE_COMMAND)
     parser.add_argument('--latest-version-command',
-                        help="Command to get the latest version in the repository. "
-                             "Default \"sudo yum clean all >/dev/null 2>&1 && sudo yum list all elasticsearch |"
-                             " grep elasticsearch | awk '{ print $2 }' | cut -d '-' -f1 | sort --version-sort -r |"
-                             " head -n 1\"",
-                        default="sudo yum clean all >/dev/null 2>&1 && sudo yum list all elasticsearch |"
-                                " grep elasticsearch | awk '{ print $2 }' | cut -d '-' -f1 | sort --version-sort -r |"
-                                " head -n 1")
+                        help="Command to get the latest version in the repository. If it outputs multiple"
+                             " versions, one per line, the highest is used."
+                             " Default \"{}\", repoquery is part of yum-utils".format(
+                                 DEFAULT_LATEST_VERSION_COMMAND.replace('%', '%%')),
+                        default=DEFAULT_LATEST_VERSION_COMMAND)
     parser.add_argument('--version',
                         help="A specific version to upgrade to or 'latest'. If 'latest', then the highest"
                              " available version in the repository will be determined. Nodes with a version"
@@ -630,11 +1112,30 @@ def main():
     parser.add_argument('--reboot', help='Reboots the server if an actual upgrade took place', action='store_true')
     parser.add_argument('--force-reboot', help='Always reboots the server, even though no upgrade occurred because'
                                                ' the version was already the latest', action='store_true')
+    parser.add_argument('--parallel-health-check', help='Checks the cluster status on all nodes at once before'
+                                                        ' starting, instead of only on the first node. All nodes must'
+                                                        ' be reachable and report green', action='store_true')
+    parser.add_argument('--ssh-timeout', help='Seconds a SSH command may take before it is aborted. Default 1800',
+                        type=int, default=1800)
     parser.add_argument('-v', '--verbose', help='Display of more information', action='store_true')
     args = parser.parse_args()
 
-    # Create nodes list from comma separated string
-    nodes = args.nodes.replace(' ', '').split(',')
+    # Progress goes to stdout and problems to stderr
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    logging.basicConfig(format='%(message)s', level=logging.INFO, handlers=[stdout_handler, stderr_handler])
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    if not args.verbose:
+        # Retries of nodes that are restarting are expected, don't warn about each of them
+        logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    # Create nodes list from comma separated string, ignoring surrounding spaces and empty entries
+    nodes = [node.strip() for node in args.nodes.split(',') if node.strip()]
+    if not nodes:
+        parser.error('argument -n/--nodes: at least one node is required')
 
     elasticsearch_upgrader = ElasticsearchUpgrader(nodes,
                                                    args.username,
@@ -650,7 +1151,11 @@ def main():
                                                    args.upgrade_system,
                                                    args.reboot,
                                                    args.force_reboot,
-                                                   args.verbose)
+                                                   args.verbose,
+                                                   download_command=args.download_command,
+                                                   check_update_command=args.check_update_command,
+                                                   parallel_health_check=args.parallel_health_check,
+                                                   ssh_timeout=args.ssh_timeout)
 
     if not elasticsearch_upgrader.upgrade():
         exit(1)
@@ -16,7 +16,6 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
     ],
     keywords='elasticsearch rolling upgrade',
@@ -24,8 +23,11 @@ setup(
     author='Pieter Vogelaar',
     author_email='pieter@pietervogelaar.nl',
     license='MIT',
+    python_requires='>=3.7',
     install_requires=[
+        'packaging',
         'requests',
+        'urllib3>=1.26',
     ],
     scripts=['elasticsearch_upgrade.py'],
     include_package_data=True,